@@ -1,30 +1,59 @@
+import csv
+import io
 import os
 import zipfile
-import tempfile
-import pandas as pd
 from fitparse import FitFile
 import argparse
-import asyncio
 import shutil
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache, partial
 from math import ceil
 
+# pyarrow is optional; without it the typed Parquet copy of the timestamp CSV is neither written nor read
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-async def extract_min_timestamp(file_path, directory):
-    try:
-        fitfile = FitFile(file_path)
+# Suffix tuples let str.endswith match both spellings without lowercasing every name
+FIT_SUFFIXES = ('.fit', '.FIT')
+ZIP_SUFFIXES = ('.zip', '.ZIP')
+
+# Number of FIT files parsed per worker task
+BATCH_SIZE = 16
+
+def read_min_timestamp(fit_source):
+    # CRC validation is a pure-Python pass over every byte and does not change the timestamps we read
+    with FitFile(fit_source, check_crc=False) as fitfile:
         min_timestamp = None
 
-        for record in fitfile.get_messages(['record']):
-            for data in record:
-                if data.name == 'timestamp':
-                    if min_timestamp is None or data.value < min_timestamp:
-                        min_timestamp = data.value
-        
+        # Activity files carry their start time in the leading file_id message,
+        # so there is no need to decode the record stream at all
+        file_id = next(fitfile.get_messages(['file_id']), None)
+        if file_id is not None and file_id.get_value('type') == 'activity':
+            min_timestamp = file_id.get_value('time_created')
+
+        # Record timestamps are monotonically non-decreasing, so the first one is the minimum
+        if min_timestamp is None:
+            record = next(fitfile.get_messages(['record']), None)
+            if record is not None:
+                min_timestamp = record.get_value('timestamp')
+
+    return min_timestamp
+
+def extract_min_timestamp(file_path, directory):
+    try:
+        # fitparse issues many small reads, so give it a large buffer instead of the default 8 KiB
+        with open(file_path, 'rb', buffering=1 << 20) as fit_data:
+            min_timestamp = read_min_timestamp(fit_data)
+
         if min_timestamp is not None:
             return {"source_file": os.path.relpath(file_path, directory), "min_timestamp": min_timestamp}
         else:
@@ -34,45 +63,167 @@ async def extract_min_timestamp(file_path, directory):
         logger.error(f"Error processing {file_path}: {e}")
         return None
 
-async def process_fit_files(directory):
+@lru_cache(maxsize=4)
+def open_zip(zip_path):
+    # Each worker keeps its archives open so the central directory is only read once per process
+    return zipfile.ZipFile(zip_path, 'r')
+
+def extract_min_timestamp_from_zip(member, zip_path):
+    try:
+        # Decode straight from the archive instead of extracting it to disk first
+        with open_zip(zip_path).open(member) as fit_data:
+            min_timestamp = read_min_timestamp(io.BytesIO(fit_data.read()))
+
+        if min_timestamp is not None:
+            return {"source_file": member, "min_timestamp": min_timestamp}
+        else:
+            return None
+
+    except Exception as e:
+        logger.error(f"Error processing {member} in {zip_path}: {e}")
+        return None
+
+def scan_files(directory):
+    # os.scandir walk with an explicit stack; entries carry their type from the directory listing, so no stat per file
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        yield entry
+        except OSError as e:
+            logger.warning(f"Cannot scan {current}: {e}")
+
+def discover(directory):
+    # One walk over the input tree, classifying every entry we can process
+    for entry in scan_files(directory):
+        if entry.name.endswith(ZIP_SUFFIXES):
+            yield 'zip', entry.path
+        elif entry.name.endswith(FIT_SUFFIXES):
+            yield 'fit', entry.path
+
+def extract_min_timestamps(file_paths, directory):
+    results = (extract_min_timestamp(file_path, directory) for file_path in file_paths)
+    return [result for result in results if result]
+
+def extract_min_timestamps_from_zip(members, zip_path):
+    results = (extract_min_timestamp_from_zip(member, zip_path) for member in members)
+    return [result for result in results if result]
+
+def process_fit_files(directory, max_workers=None):
+    futures = []
     fit_files = []
     results = []
 
-    for root, _, files in os.walk(directory):
-        for filename in files:
-            if filename.endswith('.fit'):
-                fit_files.append(os.path.join(root, filename))
+    # FIT parsing is CPU-bound, so fan it out over processes in batches to amortize IPC for the many small files.
+    # Batches are submitted as the walk finds them, so parsing overlaps directory and zip discovery.
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for kind, path in discover(directory):
+                if kind == 'fit':
+                    fit_files.append(path)
+                    if len(fit_files) == BATCH_SIZE:
+                        futures.append(executor.submit(extract_min_timestamps, fit_files, directory))
+                        fit_files = []
+                    continue
+
+                logger.info(f"Reading zip file: {path}")
+                try:
+                    with zipfile.ZipFile(path, 'r') as zip_ref:
+                        fit_members = [member for member in zip_ref.namelist() if member.endswith(FIT_SUFFIXES)]
+                except Exception as e:
+                    logger.error(f"Error reading {path}: {e}")
+                    continue
+
+                for i in range(0, len(fit_members), BATCH_SIZE):
+                    futures.append(executor.submit(extract_min_timestamps_from_zip, fit_members[i:i + BATCH_SIZE], path))
+
+            if fit_files:
+                futures.append(executor.submit(extract_min_timestamps, fit_files, directory))
+
+            for future in futures:
+                results.extend(future.result())
+        except KeyboardInterrupt:
+            # Drop queued batches so leaving the pool only waits for the ones already running
+            for future in futures:
+                future.cancel()
+            raise
 
-    tasks = [extract_min_timestamp(file_path, directory) for file_path in fit_files]
-    for result in await asyncio.gather(*tasks):
-        if result:
-            results.append(result)
-    
     return results
 
-async def unzip_and_process(directory):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        zip_files = []
+def load_timestamps(csv_file):
+    # Index the timestamps once so each zip member is an O(1) lookup; the first row wins for duplicate names
+    ts_map = {}
 
-        for root, _, files in os.walk(directory):
-            for filename in files:
-                if filename.endswith('.zip'):
-                    zip_files.append(os.path.join(root, filename))
+    # The Parquet copy keeps min_timestamp typed, so it needs no date parsing; only trust it if it is not stale
+    cache_file = csv_file + '.parquet'
+    if pq is not None and os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(csv_file):
+        try:
+            table = pq.read_table(cache_file, columns=['source_file', 'min_timestamp'])
+            for source_file, min_timestamp in zip(table.column('source_file').to_pylist(), table.column('min_timestamp').to_pylist()):
+                ts_map.setdefault(source_file, min_timestamp)
+            return ts_map
+        except Exception as e:
+            logger.warning(f"Could not read timestamp cache {cache_file}, falling back to CSV: {e}")
+            ts_map = {}
 
-        for zip_path in zip_files:
-            logger.info(f"Unzipping file: {zip_path}")
-            await unzip_file(zip_path, temp_dir)
-        
-        return await process_fit_files(temp_dir)
+    with open(csv_file, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            source_file = row['source_file']
+            if source_file in ts_map:
+                continue
+            # We write the timestamps as ISO 8601, so fromisoformat parses them without any format guessing
+            try:
+                ts_map[source_file] = datetime.fromisoformat(row['min_timestamp'])
+            except (TypeError, ValueError):
+                ts_map[source_file] = None
 
-async def unzip_file(zip_path, temp_dir):
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-    except Exception as e:
-        logger.error(f"Error unzipping {zip_path}: {e}")
+    return ts_map
+
+def select_members(zip_path, ts_map, cutoff_date):
+    selected = []
+    skipped = 0
+    zip_filename = os.path.basename(zip_path)
+
+    logger.info("Processing zip file: %s", zip_filename)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        # Walk the central directory; only the members that pass the filter are inflated later
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            file_base_name = os.path.basename(info.filename)
+
+            # Check if the file is in the CSV and if its timestamp is before the cutoff date
+            if file_base_name not in ts_map:
+                continue
+
+            file_timestamp = ts_map[file_base_name]
+            if file_timestamp is not None:
+                if file_timestamp < cutoff_date:
+                    logger.debug("File %s is older than the cutoff date.", file_base_name)
+                    selected.append((info.filename, file_base_name))
+                else:
+                    skipped += 1
+            else:
+                logger.warning("Invalid timestamp for file %s. Skipping.", file_base_name)
 
-def filter_and_copy(csv_file, zip_folder, output_folder, cutoff_date):
+    logger.info("Selected %d files from %s, skipped %d newer than the cutoff date", len(selected), zip_filename, skipped)
+    return selected
+
+def copy_members(zip_path, members, output_folder):
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member, file_base_name in members:
+            logger.debug("Copying %s from %s to %s.", file_base_name, zip_path, output_folder)
+            # Stream the member straight into the output folder
+            with zip_ref.open(member) as src, open(os.path.join(output_folder, file_base_name), 'wb') as dst:
+                shutil.copyfileobj(src, dst, length=1 << 20)
+    return len(members)
+
+def filter_and_copy(csv_file, zip_folder, output_folder, cutoff_date, max_workers=8):
     logger.info("Starting filter and copy process")
     
     # Create the output folder if it doesn't exist
@@ -80,57 +231,38 @@ def filter_and_copy(csv_file, zip_folder, output_folder, cutoff_date):
         os.makedirs(output_folder)
 
     # Load the CSV file
-    df = pd.read_csv(csv_file)
-
-    # Convert 'min_timestamp' to datetime
-    df['min_timestamp'] = pd.to_datetime(df['min_timestamp'], format='%Y-%m-%d %H:%M:%S', errors='coerce')
-
-    logger.info(f"Converted timestamps in CSV: {df['min_timestamp'].head()}")
-
-    # Loop through each zip file in the folder
-    for zip_filename in os.listdir(zip_folder):
-        if zip_filename.endswith('.zip'):
-            logger.info(f"Processing zip file: {zip_filename}")
-            with zipfile.ZipFile(os.path.join(zip_folder, zip_filename), 'r') as zip_ref:
-                # Extract the contents temporarily
-                temp_folder = 'temp_extracted'
-                zip_ref.extractall(temp_folder)
-                logger.info(f"Extracted files to {temp_folder}")
-
-                # Loop through each file in the extracted folder
-                for root, dirs, files in os.walk(temp_folder):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        file_base_name = os.path.basename(file_path)
-                        logger.info(f"Checking file: {file_base_name}")
-
-                        # Check if the file is in the CSV and if its timestamp is before the cutoff date
-                        if file_base_name in df['source_file'].values:
-                            file_timestamp = df.loc[df['source_file'] == file_base_name, 'min_timestamp'].iloc[0]
-                            logger.info(f"Original timestamp: {file_timestamp}")
-
-                            if pd.notnull(file_timestamp):
-                                logger.info(f"Valid datetime object: {file_timestamp}")
-                                if file_timestamp < cutoff_date:
-                                    logger.info(f"File {file_base_name} is older than the cutoff date. Copying to {output_folder}.")
-                                    # Copy the file to the output folder
-                                    shutil.copy(file_path, output_folder)
-                                else:
-                                    logger.info(f"File {file_base_name} is newer than the cutoff date. Skipping.")
-                            else:
-                                logger.warning(f"Invalid timestamp for file {file_base_name}. Skipping.")
-
-                # Clean up the temporary folder
-                shutil.rmtree(temp_folder)
-                logger.info(f"Cleaned up temporary folder {temp_folder}")
-
-    logger.info("Filter and copy process complete.")
+    ts_map = load_timestamps(csv_file)
+    logger.info(f"Loaded {len(ts_map)} timestamps from {csv_file}")
+
+    with os.scandir(zip_folder) as entries:
+        zip_paths = [entry.path for entry in entries if entry.name.endswith(ZIP_SUFFIXES)]
+
+    # Each zip is independent and the work is mostly inflate + write, which release the GIL, so threads suffice
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        select_func = partial(select_members, ts_map=ts_map, cutoff_date=cutoff_date)
+
+        # Members are copied under their base name, so zips can collide on a destination. Pick one source per name
+        # before copying, so no two threads write the same file; the last zip wins, as it did when copying in order.
+        chosen = {}
+        for zip_path, selected in zip(zip_paths, executor.map(select_func, zip_paths)):
+            for member, file_base_name in selected:
+                chosen[file_base_name] = (zip_path, member)
+
+        members_by_zip = {}
+        for file_base_name, (zip_path, member) in chosen.items():
+            members_by_zip.setdefault(zip_path, []).append((member, file_base_name))
+
+        copy_func = partial(copy_members, output_folder=output_folder)
+        copied_files = sum(executor.map(copy_func, members_by_zip, members_by_zip.values()))
+
+    logger.info(f"Filter and copy process complete. Copied {copied_files} files.")
 
 def batch_files(source_folder, batch_size=25):
     logger.info("Starting batch files process")
     
     # Get all files in the source folder
-    all_files = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f))]
+    with os.scandir(source_folder) as entries:
+        all_files = [entry.name for entry in entries if entry.is_file()]
     
     # Calculate the number of batches needed
     num_batches = ceil(len(all_files) / batch_size)
@@ -145,35 +277,48 @@ def batch_files(source_folder, batch_size=25):
         end_idx = min((batch_num + 1) * batch_size, len(all_files))
         batch_files = all_files[start_idx:end_idx]
         
-        # Move files to the batch folder
+        # Move files to the batch folder; it lives inside source_folder, so this is a plain rename
         for file in batch_files:
             source_path = os.path.join(source_folder, file)
             dest_path = os.path.join(batch_folder, file)
-            shutil.move(source_path, dest_path)
+            os.replace(source_path, dest_path)
         
         logger.info(f"Created batch {batch_num + 1} with {len(batch_files)} files")
 
     logger.info("Batching process complete.")
 
-async def main(args):
+def parse_cutoff_date(value):
+    # Parsed while reading the arguments, so a bad date fails before any files are processed
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{value}', expected YYYY-MM-DD")
+
+def main(args):
     logger.info("Starting main process")
     
     # Process FIT files and create CSV
-    results = []
-    results.extend(await unzip_and_process(args.input_folder))
-    results.extend(await process_fit_files(args.input_folder))
+    results = process_fit_files(args.input_folder, args.workers)
 
     if results:
-        # Convert the results to a DataFrame and save to CSV
-        df = pd.DataFrame(results)
-        df.to_csv(args.output_csv, index=False)
+        # Save the results to CSV; this is a plain write-out, so there is no need to build a DataFrame
+        with open(args.output_csv, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=['source_file', 'min_timestamp'], lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(results)
         logger.info(f"Data saved to {args.output_csv}")
+
+        # Cache a typed copy for faster reloads; this needs pyarrow and is skipped without it
+        if pq is not None:
+            try:
+                pq.write_table(pa.Table.from_pylist(results), args.output_csv + '.parquet')
+            except Exception as e:
+                logger.warning(f"Could not write timestamp cache: {e}")
     else:
         logger.warning("No data was extracted from the FIT files.")
 
     # Filter and copy files
-    cutoff_date = pd.to_datetime(args.cutoff_date)
-    filter_and_copy(args.output_csv, args.input_folder, args.output_folder, cutoff_date)
+    filter_and_copy(args.output_csv, args.input_folder, args.output_folder, args.cutoff_date)
 
     # Batch files
     batch_files(args.output_folder, args.batch_size)
@@ -185,8 +330,9 @@ if __name__ == "__main__":
     parser.add_argument('--input-folder', required=True, help="Directory containing FIT or ZIP files.")
     parser.add_argument('--output-csv', required=True, help="Path to save the output CSV file.")
     parser.add_argument('--output-folder', required=True, help="Directory to save filtered files.")
-    parser.add_argument('--cutoff-date', required=True, help="Cutoff date for filtering (YYYY-MM-DD).")
+    parser.add_argument('--cutoff-date', required=True, type=parse_cutoff_date, help="Cutoff date for filtering (YYYY-MM-DD).")
     parser.add_argument('--batch-size', type=int, default=25, help="Number of files per batch (default: 25).")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs).")
     args = parser.parse_args()
 
-    asyncio.run(main(args))
\ No newline at end of file
+    main(args)
\ No newline at end of file
@@ -3,41 +3,107 @@ import glob
 import zipfile
 import fitdecode
 import csv
-import tempfile
 import shutil
 import argparse
 import logging
+from datetime import datetime, timezone
 from fitdecode import FitReader, CrcCheck, ErrorHandling
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
-def find_zip_files(root_dir):
-    logging.info(f"Searching for ZIP files in '{root_dir}'")
+# Number of zip members each worker task parses, trading IPC overhead against load balance
+ZIP_BATCH_SIZE = 64
+
+# Error directory of the current worker process, set once per worker by init_worker
+ERROR_DIR = None
+
+def init_worker(error_dir):
+    global ERROR_DIR
+    ERROR_DIR = error_dir
+
+def fit_datetime(value):
+    # Same conversion fitdecode's DefaultDataProcessor applies to date_time fields
+    if value is not None and value >= fitdecode.FIT_DATETIME_MIN:
+        return datetime.fromtimestamp(fitdecode.FIT_UTC_REFERENCE + value, timezone.utc)
+    return value
+
+def enum_name(value):
+    return value.name if hasattr(value, 'name') else str(value)
+
+# FIT file types whose profile has no session messages; decoding stops at their file_id.
+# Anything else, including activity_summary and types this list does not know, is read in full.
+NO_SESSION_FILE_TYPES = frozenset({
+    'device', 'settings', 'sport', 'workout', 'schedules', 'weight', 'totals', 'goals', 'blood_pressure',
+    'monitoring_a', 'monitoring_daily', 'monitoring_b', 'segment_list', 'exd_configuration',
+})
+
+# Output columns; workers return each session as a row in this order
+FIELDNAMES = ['file_name', 'start_time', 'total_time_sec', 'distance_km', 'avg_hr', 'max_hr', 'sport', 'sub_sport']
+START_TIME_COLUMN = FIELDNAMES.index('start_time')
+
+# Session fields to summarize: FIT field name -> (CSV column, value conversion)
+SESSION_FIELDS = {
+    'start_time': ('start_time', fit_datetime),
+    'total_elapsed_time': ('total_time_sec', lambda v: v if v is not None else 0),
+    'total_distance': ('distance_km', lambda v: (v or 0) / 1000.0),  # Convert meters to kilometers
+    'avg_heart_rate': ('avg_hr', lambda v: v),
+    'max_heart_rate': ('max_hr', lambda v: v),
+    'sport': ('sport', enum_name),
+    'sub_sport': ('sub_sport', enum_name),
+}
+
+# The same mapping keyed to column positions, so a session is written straight into its row
+SESSION_COLUMNS = {name: (FIELDNAMES.index(key), convert) for name, (key, convert) in SESSION_FIELDS.items()}
+
+def scan_directory(directory):
+    dirs = []
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Exclude '__MACOSX' directories
+                    if not entry.name.startswith('__MACOSX'):
+                        dirs.append(entry.path)
+                else:
+                    files.append(entry)
+    except OSError as e:
+        logging.warning(f"Cannot scan '{directory}': {e}")
+    return dirs, files
+
+def scan_files(root_dir):
+    # Every directory is listed on its own thread. scandir releases the GIL, so on network or cold filesystems
+    # the round trips overlap instead of adding up; entries carry their type from the listing, so no stat per file.
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        pending = {executor.submit(scan_directory, root_dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirs, files = future.result()
+                for directory in dirs:
+                    pending.add(executor.submit(scan_directory, directory))
+                yield from files
+
+def find_input_files(root_dir):
+    logging.info(f"Searching for ZIP and .fit files in '{root_dir}'")
     zip_files = []
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        # Exclude '__MACOSX' directories
-        dirnames[:] = [d for d in dirnames if not d.startswith('__MACOSX')]
-        for filename in filenames:
-            if filename.lower().endswith('.zip'):
-                zip_path = os.path.join(dirpath, filename)
-                zip_files.append(zip_path)
-    logging.info(f"Found {len(zip_files)} ZIP files in '{root_dir}'")
-    return zip_files
-
-def find_fit_files(root_dir):
-    logging.info(f"Searching for .fit files in '{root_dir}'")
     fit_files = []
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        # Exclude '__MACOSX' directories
-        dirnames[:] = [d for d in dirnames if not d.startswith('__MACOSX')]
-        for filename in filenames:
-            if filename.startswith('.'):
-                continue  # Skip hidden files
-            if filename.lower().endswith('.fit'):
-                fit_path = os.path.join(dirpath, filename)
-                fit_files.append(fit_path)
-    logging.info(f"Found {len(fit_files)} .fit files in '{root_dir}'")
-    return fit_files
+    # A single walk classifies both kinds of input
+    for entry in scan_files(root_dir):
+        name = entry.name
+        # Suffixes match in any case; lowering only the last four characters keeps the check cheap
+        suffix = name[-4:].lower()
+        if suffix == '.zip':
+            zip_files.append(entry.path)
+        elif suffix == '.fit' and not name.startswith('.'):  # Skip hidden files
+            fit_files.append(entry.path)
+    logging.info(f"Found {len(zip_files)} ZIP files and {len(fit_files)} .fit files in '{root_dir}'")
+    return zip_files, fit_files
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 def clear_error_directory(error_dir):
     if os.path.exists(error_dir):
@@ -49,99 +115,119 @@ def clear_error_directory(error_dir):
             except Exception as e:
                 logging.error(f"Failed to delete file '{f}' from error directory: {e}", exc_info=True)
 
-def extract_activity_data_from_file(fit_path, error_dir):
+def extract_activity_data(fit_source, fit_name):
+    # Use fitdecode to read the FIT file
+    logging.debug("Processing file '%s'", fit_name)
     try:
-        # Use fitdecode to read the FIT file
-        logging.debug(f"Processing file '{fit_path}'")
-        try:
-            fit_file = FitReader(
-                fit_path,
-                check_crc=CrcCheck.DISABLED,  # Use the CrcCheck enum
-                error_handling=ErrorHandling.WARN  # Use the ErrorHandling enum
-            )
-        except Exception as e:
-            logging.error(f"Error initializing FitReader for file '{fit_path}': {e}", exc_info=True)
-            raise
-
-        with fit_file as fit:
-            sessions = []
-            for frame in fit:
-                if isinstance(frame, fitdecode.FitDataMessage):
-                    try:
-                        if frame.name == 'session':
-                            # Start a new session summary
-                            summary = {}
-                            for field in frame.fields:
-                                if field.name == 'start_time':
-                                    summary['start_time'] = field.value
-                                    logging.debug(f"Start time: {field.value}")
-                                elif field.name == 'total_elapsed_time':
-                                    total_elapsed_time = field.value if field.value is not None else 0
-                                    summary['total_time_sec'] = total_elapsed_time
-                                    logging.debug(f"Total elapsed time: {total_elapsed_time}")
-                                elif field.name == 'total_distance':
-                                    total_distance = field.value if field.value else 0
-                                    summary['distance_km'] = total_distance / 1000.0  # Convert meters to kilometers
-                                    logging.debug(f"Total distance: {total_distance}")
-                                elif field.name == 'avg_heart_rate':
-                                    summary['avg_hr'] = field.value
-                                    logging.debug(f"Average heart rate: {field.value}")
-                                elif field.name == 'max_heart_rate':
-                                    summary['max_hr'] = field.value
-                                    logging.debug(f"Max heart rate: {field.value}")
-                                elif field.name == 'sport':
-                                    sport = field.value.name if hasattr(field.value, 'name') else str(field.value)
-                                    summary['sport'] = sport
-                                    logging.debug(f"Sport: {sport}")
-                                elif field.name == 'sub_sport':
-                                    sub_sport = field.value.name if hasattr(field.value, 'name') else str(field.value)
-                                    summary['sub_sport'] = sub_sport
-                                    logging.debug(f"Sub Sport: {sub_sport}")
-                            # Add file name to the summary
-                            summary['file_name'] = fit_path
-                            # Append the session summary to the list
-                            sessions.append(summary)
-                        # Additional logic for 'record' messages can be added here if needed
-                    except Exception as e:
-                        logging.warning(f"Error processing message '{frame.name}' in file '{fit_path}': {e}", exc_info=True)
-                        continue
-
-            if sessions:
-                logging.debug(f"Extracted {len(sessions)} sessions from '{fit_path}'")
-                return sessions
-            else:
-                logging.debug(f"No session data found in '{fit_path}'")
-                return None
+        # No data processor: it runs per field of every record, and the only value we need converted is start_time
+        fit_file = FitReader(
+            fit_source,
+            processor=None,
+            check_crc=CrcCheck.DISABLED,  # Use the CrcCheck enum
+            error_handling=ErrorHandling.WARN  # Use the ErrorHandling enum
+        )
+    except Exception as e:
+        logging.error(f"Error initializing FitReader for file '{fit_name}': {e}", exc_info=True)
+        raise
+
+    with fit_file as fit:
+        sessions = []
+        first_record_time = None
+        for frame in fit:
+            if isinstance(frame, fitdecode.FitDataMessage):
+                try:
+                    if frame.name == 'record':
+                        # Records are chronological, so only the first timestamp is worth keeping
+                        if first_record_time is None:
+                            first_record_time = frame.get_value('timestamp', fallback=None)
+                    elif frame.name == 'file_id':
+                        # Stop before decoding monitoring, settings and other file types that never carry sessions
+                        file_type = frame.get_value('type', fallback=None)
+                        if file_type in NO_SESSION_FILE_TYPES:
+                            logging.debug("Skipping '%s': file type is '%s'", fit_name, file_type)
+                            break
+                    elif frame.name == 'session':
+                        # Start a new session row; fields the session lacks stay empty
+                        row = [None] * len(FIELDNAMES)
+                        row[0] = fit_name
+                        for field in frame.fields:
+                            spec = SESSION_COLUMNS.get(field.name)
+                            if spec is None:
+                                continue
+                            column, convert = spec
+                            row[column] = convert(field.value)
+                        sessions.append(row)
+                except Exception as e:
+                    logging.warning(f"Error processing message '{frame.name}' in file '{fit_name}': {e}", exc_info=True)
+                    continue
 
+        # Sessions without a start time fall back to the first record, found in the same decoding pass
+        for row in sessions:
+            if row[START_TIME_COLUMN] is None and first_record_time is not None:
+                row[START_TIME_COLUMN] = fit_datetime(first_record_time)
+
+        if sessions:
+            logging.debug("Extracted %d sessions from '%s'", len(sessions), fit_name)
+            return sessions
+        else:
+            logging.debug("No session data found in '%s'", fit_name)
+            return None
+
+def extract_activity_data_from_file(fit_path):
+    try:
+        return extract_activity_data(fit_path, fit_path)
     except Exception as e:
         logging.error(f"Error processing file '{fit_path}': {e}", exc_info=True)
         # Copy the problematic file to the error directory
         try:
-            os.makedirs(error_dir, exist_ok=True)
-            shutil.copy2(fit_path, error_dir)
-            logging.debug(f"Copied '{fit_path}' to error directory '{error_dir}'")
+            os.makedirs(ERROR_DIR, exist_ok=True)
+            shutil.copy2(fit_path, ERROR_DIR)
+            logging.debug("Copied '%s' to error directory '%s'", fit_path, ERROR_DIR)
         except Exception as copy_error:
             logging.error(f"Failed to copy '{fit_path}' to error directory: {copy_error}", exc_info=True)
         return 'error'  # Return a special value to indicate an error
 
-def process_zip_file(zip_path, temp_dir):
+def extract_activity_data_from_files(fit_paths):
+    return [(fit_path, extract_activity_data_from_file(fit_path)) for fit_path in fit_paths]
+
+def extract_activity_data_from_zip(zip_path, members):
+    # Parse a batch of zip members in this worker and report one result per member.
+    # fitdecode reads sequentially, so each member is decoded straight from the inflating stream.
+    results = []
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member in members:
+            fit_name = os.path.join(zip_path, member)
+            try:
+                with zip_ref.open(member) as fit_data:
+                    results.append((fit_name, extract_activity_data(fit_data, fit_name)))
+            except Exception as e:
+                logging.error(f"Error processing file '{fit_name}': {e}", exc_info=True)
+                # Save the problematic file to the error directory
+                try:
+                    os.makedirs(ERROR_DIR, exist_ok=True)
+                    with zip_ref.open(member) as src, open(os.path.join(ERROR_DIR, os.path.basename(member)), 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    logging.debug("Copied '%s' to error directory '%s'", fit_name, ERROR_DIR)
+                except Exception as copy_error:
+                    logging.error(f"Failed to copy '{fit_name}' to error directory: {copy_error}", exc_info=True)
+                results.append((fit_name, 'error'))
+    return results
+
+def find_zip_fit_members(zip_path):
     try:
-        logging.debug(f"Processing ZIP file '{zip_path}'")
+        logging.debug("Processing ZIP file '%s'", zip_path)
+        basename = os.path.basename
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # Extract all files except those in '__MACOSX' directories or starting with '._'
-            for member in zip_ref.namelist():
-                if '__MACOSX' in member or os.path.basename(member).startswith('._'):
-                    continue
-                zip_ref.extract(member, temp_dir)
-        # Find .fit files in the extracted content
-        fit_files = []
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                if file.startswith('.'):
-                    continue  # Skip hidden files
-                if file.lower().endswith('.fit'):
-                    fit_files.append(os.path.join(root, file))
-        return fit_files
+            # Only .fit files, skipping '__MACOSX' directories and hidden files such as '._' resource forks
+            infos = [
+                info for info in zip_ref.infolist()
+                if info.filename[-4:].lower() == '.fit'
+                and '__MACOSX' not in info.filename
+                and not basename(info.filename).startswith('.')
+            ]
+        # Largest members first, so the long rides are not the ones left running at the tail
+        infos.sort(key=lambda info: info.file_size, reverse=True)
+        return [info.filename for info in infos]
     except zipfile.BadZipFile:
         logging.warning(f"Skipping bad zip file '{zip_path}'")
         return []
@@ -149,6 +235,11 @@ def process_zip_file(zip_path, temp_dir):
         logging.error(f"Error processing ZIP file '{zip_path}': {e}", exc_info=True)
         return []
 
+def cancel_pending(futures):
+    # Drop queued batches so shutdown only waits for the ones already running (cancel_futures needs Python 3.9)
+    for future in futures:
+        future.cancel()
+
 def main():
     parser = argparse.ArgumentParser(description='Process Garmin .fit files into a CSV summary.')
     parser.add_argument('root_dir', help='Root directory containing .fit files or zip archives')
@@ -195,89 +286,94 @@ def main():
     # Clear the error directory before processing
     clear_error_directory(error_dir)
 
-    # Use a temporary directory for unzipping files
-    temp_dir = tempfile.mkdtemp()
-    all_fit_files = []
-
     # Counters for summary
     total_files = 0
     successful_files = 0
     error_files = 0
 
-    try:
-        # Find and process ZIP files
-        zip_files = find_zip_files(root_dir)
-        logging.info(f"Processing {len(zip_files)} ZIP files...")
-        for zip_file in zip_files:
-            zip_temp_dir = tempfile.mkdtemp(dir=temp_dir)
-            fit_files = process_zip_file(zip_file, zip_temp_dir)
-            all_fit_files.extend(fit_files)
-
-        # Find .fit files directly in root_dir
-        logging.info("Searching for .fit files in root directory...")
-        all_fit_files.extend(find_fit_files(root_dir))
-
-        total_files = len(all_fit_files)
-        logging.info(f"Total .fit files to process: {total_files}")
-
-        # Process .fit files in parallel
-        activities = []
-        processed_files = 0
-        logging.info("Processing .fit files...")
-        extract_func = partial(extract_activity_data_from_file, error_dir=error_dir)
-
-        with ProcessPoolExecutor(max_workers=num_workers) as executor:
-            futures = {executor.submit(extract_func, fit_path): fit_path for fit_path in all_fit_files}
+    # Find ZIP files and .fit files directly in root_dir; zip contents are listed and parsed on the worker pool below
+    zip_files, fit_files = find_input_files(root_dir)
+    total_files += len(fit_files)
+
+    # Process .fit files in parallel
+    processed_files = 0
+    activity_count = 0
+    logging.info("Processing .fit files...")
+
+    # Rows are written as results arrive, so memory stays flat and disk writes overlap with parsing
+    with open(output_csv, 'w', newline='', buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+
+        # Listing a zip only reads its central directory, which is I/O bound, so that stage runs on threads; as each
+        # listing completes its members are queued for parsing on the process pool right behind the loose files.
+        # The error directory is handed to each worker process once.
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 4)) as lister, \
+                ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker, initargs=(error_dir,)) as executor:
+            listings = {lister.submit(find_zip_fit_members, zip_file): zip_file for zip_file in zip_files}
+            pending = set(listings)
+            # Loose files are sent in chunks to cut IPC per file. Sorting largest first and dealing the files out
+            # round-robin gives every chunk a similar amount of work, each starting with its biggest files.
+            fit_files.sort(key=file_size, reverse=True)
+            chunksize = max(1, len(fit_files) // ((num_workers or 1) * 4))
+            num_chunks = -(-len(fit_files) // chunksize)
+            for i in range(num_chunks):
+                pending.add(executor.submit(extract_activity_data_from_files, fit_files[i::num_chunks]))
             try:
-                for future in as_completed(futures):
-                    fit_path = futures[future]
-                    processed_files += 1
-                    logging.info(f"Processed file {processed_files}/{total_files}: '{fit_path}'")
-                    data = future.result()
-                    if data == 'error':
-                        error_files += 1
-                    elif data:
-                        if isinstance(data, list):
-                            activities.extend(data)
-                            successful_files += 1
-                            logging.debug(f"Extracted {len(data)} activities from '{fit_path}'")
-                        else:
-                            activities.append(data)
-                            successful_files += 1
-                            logging.debug(f"Extracted activity data from '{fit_path}'")
-                    else:
-                        logging.debug(f"No activity data found in '{fit_path}'")
+                while pending:
+                    # as_completed cannot take new futures mid-iteration, so wait on the pending set directly
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future in listings:
+                            zip_file = listings[future]
+                            members = future.result()
+                            total_files += len(members)
+                            for i in range(0, len(members), ZIP_BATCH_SIZE):
+                                pending.add(executor.submit(extract_activity_data_from_zip, zip_file, members[i:i + ZIP_BATCH_SIZE]))
+                            continue
+
+                        # Every parse task reports a (name, data) pair per file
+                        for fit_path, data in future.result():
+                            processed_files += 1
+                            # Progress goes out every 100 files; a log call per file costs more than parsing a short activity
+                            logging.debug("Processed file %d/%d: '%s'", processed_files, total_files, fit_path)
+                            if processed_files % 100 == 0:
+                                logging.info(f"Processed {processed_files}/{total_files} files")
+                            if data == 'error':
+                                error_files += 1
+                            elif data:
+                                writer.writerows(data)
+                                activity_count += len(data)
+                                successful_files += 1
+                                logging.debug("Extracted %d activities from '%s'", len(data), fit_path)
+                            else:
+                                logging.debug("No activity data found in '%s'", fit_path)
+
+                            # Push what we have to disk now and then, so an interrupted run keeps its rows
+                            if processed_files % 256 == 0:
+                                csvfile.flush()
             except KeyboardInterrupt:
                 logging.warning("Processing interrupted by user (Ctrl-C).")
+                cancel_pending(pending)
+                lister.shutdown(wait=False)
                 executor.shutdown(wait=False)
             except Exception as e:
                 logging.error(f"An error occurred during multiprocessing: {e}", exc_info=True)
+                cancel_pending(pending)
+                lister.shutdown(wait=False)
                 executor.shutdown(wait=False)
 
-        # Write to CSV
-        if activities:
-            fieldnames = ['file_name', 'start_time', 'total_time_sec', 'distance_km',
-                          'avg_hr', 'max_hr', 'sport', 'sub_sport']
-            with open(output_csv, 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for activity in activities:
-                    writer.writerow(activity)
-            logging.info(f"Data successfully written to '{output_csv}'")
-        else:
-            logging.warning("No activity data found in any files.")
-        
-        # Output summary
-        logging.info("Processing complete.")
-        logging.info(f"Total files processed: {total_files}")
-        logging.info(f"Successful files: {successful_files}")
-        logging.info(f"Files with errors: {error_files}")
-        logging.info(f"Error files are copied to '{os.path.abspath(error_dir)}'")
-
-    finally:
-        # Clean up temp directory
-        shutil.rmtree(temp_dir)
-        logging.info("Cleaned up temporary files.")
+    if activity_count:
+        logging.info(f"Data successfully written to '{output_csv}'")
+    else:
+        logging.warning("No activity data found in any files.")
+    
+    # Output summary
+    logging.info("Processing complete.")
+    logging.info(f"Total files processed: {total_files}")
+    logging.info(f"Successful files: {successful_files}")
+    logging.info(f"Files with errors: {error_files}")
+    logging.info(f"Error files are copied to '{os.path.abspath(error_dir)}'")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()